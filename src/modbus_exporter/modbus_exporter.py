@@ -1,9 +1,33 @@
+from asyncio import Lock, create_task, gather, shield, sleep, wait_for
+from contextvars import ContextVar
+from logging import DEBUG
+from math import isfinite, isnan
+from time import monotonic
+
 from prometheus_exporter import Exporter, Metric
 from zenlib.util.colorize import colorize as c_
 from zenlib.util import pretty_print
 from pymodbus.client.serial import AsyncModbusSerialClient
 from pymodbus.client.tcp import AsyncModbusTcpClient
-from pymodbus.exceptions import ConnectionException
+from pymodbus.exceptions import ConnectionException, ModbusException
+
+from .registers import MAX_BLOCK, RegEntry, plan_reads
+
+
+# Set while export renders the modbus values itself, so get_metrics only returns the base metrics for that request
+_exporting_text = ContextVar("exporting_text", default=False)
+
+
+def _escape_help(text):
+    """Escape help text for the Prometheus text format."""
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _format_value(value):
+    """Format a register value for the Prometheus text format, which spells out non-finite floats."""
+    if isinstance(value, float) and not isfinite(value):
+        return "NaN" if isnan(value) else ("+Inf" if value > 0 else "-Inf")
+    return str(value)
 
 
 class ModbusExporter(Exporter):
@@ -12,14 +36,26 @@ class ModbusExporter(Exporter):
     def __init__(self, *args, **kwargs):
         self.endpoints = []
         kwargs["listen_port"] = kwargs.pop("listen_port", 9502)
+        self._reconnect_task = None
+        self._keepalive_task = None
+        self._poll_task = None
+        self._latest_snapshot = []
+        self._client_lock = Lock()
+        self._inflight = None
         super().__init__(*args, **kwargs)
 
     async def startup_tasks(self, *args, **kwargs):
+        # Automatic reconnects in pymodbus are disabled, _reconnect is the only reconnect loop
+        client_args = {"reconnect_delay": 0}
+        # Only override the pymodbus retry count when configured, each retry waits for the full timeout again
+        if self.retries is not None:
+            client_args["retries"] = self.retries
         if self.mode == "tcp":
             self.client = AsyncModbusTcpClient(
                 host=self.transport_config["host"],
                 port=self.transport_config["port"],
                 timeout=self.timeout,
+                **client_args,
             )
 
         elif self.mode == "rtu":
@@ -30,10 +66,78 @@ class ModbusExporter(Exporter):
                 parity=self.transport_config["parity"],
                 bytesize=self.transport_config["bytesize"],
                 stopbits=self.transport_config["stopbits"],
+                **client_args,
             )
         else:
             raise ValueError("Invalid Modbus mode defined, must be 'tcp' or 'rtu'.")
 
+        await self._connect()
+        if not self.client.connected:
+            self._trigger_reconnect()
+
+        if self.keepalive and self._register_plan:
+            self._keepalive_task = create_task(self._keepalive())
+
+        if self.poll_interval:
+            self._poll_task = create_task(self._poll_loop())
+
+    async def _connect(self):
+        """Attempt to connect to the modbus device once, returns True if connected."""
+        try:
+            await self.client.connect()
+        except ConnectionException as e:
+            self.logger.error("Connection error: %s", e)
+        return self.client.connected
+
+    async def _reconnect(self):
+        """Reconnect to the modbus device, doubling the delay between attempts up to reconnect_delay_max."""
+        delay = self.reconnect_delay
+        while not await self._connect():
+            self.logger.warning("Unable to connect to Modbus device, retrying in %ss", delay)
+            await sleep(delay)
+            delay = min(delay * 2, self.reconnect_delay_max)
+        self.logger.info(f"[{c_(self.mode.upper(), 'blue')}] Connected to Modbus device")
+
+    def _trigger_reconnect(self):
+        """Start a reconnect task in the background, if one is not already running."""
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = create_task(self._reconnect())
+
+    async def _keepalive(self):
+        """Periodically read the first planned register, so dead connections are detected between scrapes."""
+        address = self._register_plan[0].start
+        while True:
+            await sleep(self.keepalive)
+            if not self.client.connected:
+                self._trigger_reconnect()
+                continue
+
+            try:
+                async with self._client_lock:
+                    await self.client.read_holding_registers(address=address, count=1, device_id=self.device_id)
+            except (ModbusException, TimeoutError) as e:
+                # Half-open sockets show up as timeouts rather than connection errors
+                self.logger.error("Keepalive failed: %s", e)
+                self.client.close()
+                self._trigger_reconnect()
+
+    async def _poll_loop(self):
+        """Read all registers every poll_interval seconds, replacing the snapshot returned by get_metrics.
+        Errors clear the snapshot, so stale values are not exported, and polling continues.
+        """
+        while True:
+            started = monotonic()
+            try:
+                if self.client.connected:
+                    self._latest_snapshot = await self.read_modbus_values()
+                else:
+                    self._latest_snapshot = []
+                    self._trigger_reconnect()
+            except Exception as e:
+                self.logger.exception("Error polling Modbus device: %s", e)
+                self._latest_snapshot = []
+            await sleep(max(0, self.poll_interval - (monotonic() - started)))
+
     def read_config(self):
         """Ensure modbus config is defined, use that to define endpoints, which will then read the config."""
         super().read_config()
@@ -64,54 +168,243 @@ class ModbusExporter(Exporter):
         self.logger.info(f"[{c_(self.mode.upper(), 'blue')}] Transport config: {pretty_print(self.transport_config)}")
 
         self.timeout = self.config["modbus"].get("timeout", 1)
+        self.retries = self.config["modbus"].get("retries")
         self.device_id = self.config["modbus"].get("device_id", 1)
+        self.keepalive = self.config["modbus"].get("keepalive", 30 if self.mode == "tcp" else 0)
+        self.reconnect_delay = self.config["modbus"].get("reconnect_delay", 1)
+        self.reconnect_delay_max = self.config["modbus"].get("reconnect_delay_max", 60)
+        if self.reconnect_delay <= 0:
+            raise ValueError("Invalid reconnect_delay defined, must be greater than 0.")
+        self.poll_interval = self.config["modbus"].get("poll_interval", 0)
         self.modbus_registers = self.config["modbus"].get("registers", {})
 
-    async def get_modbus_values(self):
-        """ Iterate over all modbus register sections.
-        Key name is the help text, value is the register address.
-        The name of the sectoin is used for the metric name.
+        self.max_block = self.config["modbus"].get("max_block", MAX_BLOCK[self.mode])
+        if not 1 <= self.max_block <= MAX_BLOCK["tcp"]:
+            raise ValueError(f"Invalid max_block defined, must be between 1 and {MAX_BLOCK['tcp']}.")
+        self.max_gap = self.config["modbus"].get("max_gap", 0)
+
+        entries = [
+            RegEntry.from_config(metric_list, key, address, self.device_id)
+            for metric_list, metric_info in self.modbus_registers.items()
+            for key, address in metric_info.items()
+        ]
+        for entry in entries:
+            if entry.words > self.max_block:
+                raise ValueError(f"[{entry.metric_list}] '{entry.name}' is larger than max_block: {entry.words}")
+
+        self._entries = entries  # Config order, which keeps each section's metrics together
+        self._register_plan = plan_reads(entries, self.max_block, self.max_gap)
+        self._cache = {}  # Run index: (deadline, values), for runs with a scan interval
+        self.logger.info(
+            f"Planned {c_(len(self._register_plan), 'green')} block reads for {c_(len(entries), 'green')} registers"
+        )
+        self._build_text_templates(entries)
 
-        The register address and device ID are added as labels.
+        if self.mode == "rtu" and self.config["modbus"].get("adaptive_timeout", False):
+            self._set_adaptive_timeouts(self.config["modbus"].get("timeout_slack", 0.2))
+
+    def _build_text_templates(self, entries):
+        """Pre-render the text exposition for each metric, so scrapes only need to format the values.
+        Registers are grouped under their section name with a single HELP and TYPE header.
+        The help text of a section is set in the modbus.help table, defaulting to the section name,
+        and is used for both text and Metric exports.
         """
-        metrics = []
-        for metric_list, metric_info in self.modbus_registers.items():
-            for name, address in metric_info.items():
-                try:
-                    value = await self.client.read_holding_registers(address=address, count=1, device_id=self.device_id)
-                except ConnectionException as e:
-                    self.logger.critical("Connection error: %s", e)
-                    continue
+        sections = {}
+        for entry in entries:
+            sections.setdefault(entry.metric_list, []).append(entry)
+        help_config = self.config["modbus"].get("help", {})
+        self._section_help = {name: help_config.get(name, name) for name in sections}
+
+        self._text_templates = []  # (header, [(entry, sample prefix)])
+        for name, section in sections.items():
+            header = f"# HELP {name} {_escape_help(self._section_help[name])}\n# TYPE {name} gauge\n"
+            samples = []
+            for entry in section:
+                labels = ",".join(f'{label}="{value}"' for label, value in entry.labels.items())
+                samples.append((entry, f"{name}{{{labels}}} "))
+            self._text_templates.append((header, samples))
+
+    def _set_adaptive_timeouts(self, slack):
+        """Set the timeout for each RTU block read from the time its frames take on the wire.
+        Each character is a start bit, the data bits, an optional parity bit and the stop bits.
+        The wire time is doubled and the slack added, the configured timeout is never exceeded.
+        """
+        parity_bits = 0 if self.transport_config["parity"] == "N" else 1
+        char_bits = 1 + self.transport_config["bytesize"] + parity_bits + self.transport_config["stopbits"]
+        byte_time = char_bits / self.transport_config["baudrate"]
+        for run in self._register_plan:
+            run.timeout = min(self.timeout, byte_time * run.rtu_frame_bytes * 2 + slack)
+            self.logger.debug("Timeout for registers %s-%s: %.3fs", run.start, run.end - 1, run.timeout)
+
+    async def _read_run(self, run):
+        """Read a block of registers, returning (entry, value) pairs for each register in it.
+        Returns None if the device returned an error or the read timed out, transport errors are raised.
+        """
+        request = self.client.read_holding_registers(address=run.start, count=run.length, device_id=self.device_id)
+        try:
+            value = await (wait_for(request, run.timeout) if run.timeout else request)
+        except TimeoutError:
+            self.logger.error("Timed out reading registers %s-%s after %.3fs", run.start, run.end - 1, run.timeout)
+            # Wait out the full timeout so a late response arrives before the next request is sent,
+            # rather than being taken as its reply
+            await sleep(max(0, self.timeout - run.timeout))
+            return None
 
-                if value.isError():
-                    self.logger.error("Error reading register %s: %s", address, value)
+        if value.isError():
+            self.logger.error("Error reading registers %s-%s: %s", run.start, run.end - 1, value)
+            return None
+
+        if len(value.registers) != run.length:
+            self.logger.error(
+                "Expected %s registers from %s-%s, got %s", run.length, run.start, run.end - 1, len(value.registers)
+            )
+            return None
+
+        log = self.logger
+        data = run.pack(*value.registers)
+        readings = [decode(data, offset)[0] for decode, offset in zip(run.decoders, run.offsets)]
+        if log.isEnabledFor(DEBUG):
+            device_id = self.device_id
+            for entry, reading in zip(run.entries, readings):
+                log.debug("[%s] %s: %s", device_id, entry.name, reading)
+
+        return list(zip(run.entries, readings))
+
+    async def read_modbus_values(self):
+        """ Read each block in the register plan, then decode the registers in it.
+        Returns a list of (entry, value) pairs in config order, blocks within their scan interval use cached values.
+
+        In TCP mode, blocks are read concurrently, RTU requests must be sent one at a time.
+        A Modbus transport error stops the remaining RTU reads and reconnects the client,
+        the values which were read successfully are still returned.
+        The client lock is held while reading, so background tasks cannot interleave requests.
+        """
+        log, cache, read_run = self.logger, self._cache, self._read_run
+        now = monotonic()
+        values = []
+        pending = []
+        for index, run in enumerate(self._register_plan):
+            if run.scan_interval:
+                deadline, cached = cache.get(index, (0, None))
+                if deadline > now:
+                    log.debug("Using cached values for registers %s-%s", run.start, run.end - 1)
+                    values.extend(cached)
                     continue
-                self.logger.info(f"[{self.device_id}] {name}: {value.registers[0]}")
-                metric = Metric(
-                    name=metric_list,
-                    labels={"device_id": str(self.device_id), "address": str(address)},
-                    value=value.registers[0],
-                    type="gauge",
-                    help=name,
-                    logger=self.logger,
-                )
-                metrics.append(metric)
-
-        return metrics
+            pending.append((index, run))
 
-    async def get_metrics(self, label_filter={}):
-        """Get metrics list from each endpoint, add them together"""
-        metric_list = await super().get_metrics(label_filter=label_filter)
+        results = []
+        async with self._client_lock:
+            if self.mode == "tcp":
+                # Let every read settle before handling errors, so no request outlives the lock
+                results = await gather(*(read_run(run) for _, run in pending), return_exceptions=True)
+            else:
+                for _, run in pending:
+                    try:
+                        results.append(await read_run(run))
+                    except ModbusException as e:
+                        results.append(e)
+                        break
+
+        error = None
+        now = monotonic()
+        for (index, run), run_values in zip(pending, results):
+            if isinstance(run_values, Exception):
+                if not isinstance(run_values, ModbusException):
+                    raise run_values
+                error = run_values
+                continue
+            if run_values is None:
+                continue
+            if run.scan_interval:
+                cache[index] = (now + run.scan_interval, run_values)
+            values.extend(run_values)
+
+        if error is not None:
+            log.critical("Modbus transport error: %s", error)
+            self.client.close()
+            self._trigger_reconnect()
+
+        # Blocks are read in address order, which interleaves sections
+        readings = dict(values)
+        return [(entry, readings[entry]) for entry in self._entries if entry in readings]
+
+    def _make_metrics(self, values):
+        """Turn (entry, value) pairs, as returned by read_modbus_values, into gauge metrics.
+        The entry's section is used for the metric name and to look up the section help text,
+        and its pre-built device ID and address labels are attached.
+        """
+        log, make_metric, section_help = self.logger, Metric, self._section_help
+        return [
+            make_metric(
+                name=entry.metric_list,
+                labels=entry.labels,
+                value=reading,
+                type="gauge",
+                help=section_help[entry.metric_list],
+                logger=log,
+            )
+            for entry, reading in values
+        ]
+
+    def _render_values(self, values):
+        """Render (entry, value) pairs in the Prometheus text format, using the pre-rendered templates."""
+        readings = dict(values)
+        lines = []
+        for header, samples in self._text_templates:
+            section = [f"{prefix}{_format_value(readings[entry])}\n" for entry, prefix in samples if entry in readings]
+            if section:
+                lines.append(header)
+                lines.extend(section)
+        return "".join(lines)
+
+    async def _shared_modbus_values(self):
+        """Read modbus values, concurrent callers share the result of a single in-flight read."""
+        if self._inflight is None:
+            self._inflight = create_task(self.read_modbus_values())
+            self._inflight.add_done_callback(self._clear_inflight)
+        # Shielded so a cancelled scrape does not cancel the read for the others waiting on it
+        return await shield(self._inflight)
+
+    def _clear_inflight(self, task):
+        self._inflight = None
+
+    async def _current_values(self):
+        """Get the (entry, value) pairs for a scrape, from the background poll or a shared read."""
+        if self.poll_interval:
+            return self._latest_snapshot
 
         if not self.client.connected:
-            try:
-                await self.client.connect()
-            except ConnectionException as e:
-                self.logger.critical("Connection error: %s", e)
-                return metric_list
+            self.logger.warning("Not connected to Modbus device, skipping register reads")
+            self._trigger_reconnect()
+            return []
+
+        return await self._shared_modbus_values()
 
-        metric_list += await self.get_modbus_values()
+    async def get_metrics(self, label_filter={}):
+        """Get metrics list from each endpoint, add them together"""
+        metric_list = await super().get_metrics(label_filter=label_filter)
+        if not _exporting_text.get():
+            metric_list += self._make_metrics(await self._current_values())
 
         self.logger.debug("Got %d metrics", len(metric_list))
         self.metrics = metric_list
         return metric_list
+
+    async def export(self, label_filter={}):
+        """Export metrics as text.
+        Without a label filter, the base class exports the base metrics, then modbus values
+        are rendered directly from the pre-rendered templates, skipping Metric objects.
+        Filtered requests use the Metric objects from get_metrics.
+        """
+        if label_filter:
+            return await super().export(label_filter=label_filter)
+
+        token = _exporting_text.set(True)
+        try:
+            text = await super().export(label_filter=label_filter)
+        finally:
+            _exporting_text.reset(token)
+
+        if text and not text.endswith("\n"):
+            text += "\n"
+        return text + self._render_values(await self._current_values())
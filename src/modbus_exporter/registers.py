@@ -0,0 +1,129 @@
+from dataclasses import dataclass, field
+from math import isfinite
+from struct import Struct
+
+# Number of 16-bit words each supported data type occupies
+DATA_TYPES = {
+    "int16": 1,
+    "uint16": 1,
+    "int32": 2,
+    "uint32": 2,
+    "float32": 2,
+}
+
+_STRUCTS = {
+    "int16": Struct(">h"),
+    "uint16": Struct(">H"),
+    "int32": Struct(">i"),
+    "uint32": Struct(">I"),
+    "float32": Struct(">f"),
+}
+
+if _STRUCTS.keys() != DATA_TYPES.keys() or any(_STRUCTS[t].size != words * 2 for t, words in DATA_TYPES.items()):
+    raise ValueError("DATA_TYPES does not match the sizes of the data type structs.")
+
+# Register blocks are packed into big-endian bytes once per read, each value is unpacked from its offset
+DECODER_MAP = {data_type: struct.unpack_from for data_type, struct in _STRUCTS.items()}
+
+# Largest number of holding registers which can be requested at once, per mode
+MAX_BLOCK = {"tcp": 125, "rtu": 120}
+
+
+@dataclass(frozen=True, slots=True, eq=False)
+class RegEntry:
+    """A single configured register, exported as one metric.
+    Entries compare and hash by identity, so they can be used to key their values.
+    """
+
+    metric_list: str
+    name: str
+    address: int
+    data_type: str = "uint16"
+    words: int = 1
+    scan_interval: float = 0
+    labels: dict = field(default_factory=dict, compare=False)
+
+    @property
+    def end(self):
+        return self.address + self.words
+
+    @classmethod
+    def from_config(cls, metric_list, key, address, device_id):
+        """Parse a register definition from the config.
+        The key is the help text, optionally suffixed with ':<data_type>', defaulting to uint16,
+        and '@<seconds>', the minimum time between reads of the register, defaulting to every scrape.
+        The register address and device ID labels are built here, as they do not change between scrapes.
+        """
+        key, _, scan_interval = key.partition("@")
+        try:
+            scan_interval = float(scan_interval or 0)
+        except ValueError:
+            raise ValueError(f"[{metric_list}] Invalid scan interval for '{key}': {scan_interval}")
+        if not isfinite(scan_interval) or scan_interval < 0:
+            raise ValueError(f"[{metric_list}] Invalid scan interval for '{key}': {scan_interval}")
+
+        name, _, data_type = key.partition(":")
+        data_type = data_type.strip().lower() or "uint16"
+        if data_type not in DATA_TYPES:
+            raise ValueError(f"[{metric_list}] Invalid data type for '{name}': {data_type}")
+
+        if not isinstance(address, int) or not 0 <= address <= 0xFFFF:
+            raise ValueError(f"[{metric_list}] Invalid register address for '{name}': {address}")
+
+        labels = {"device_id": str(device_id), "address": str(address)}
+        return cls(metric_list, name.strip(), address, data_type, DATA_TYPES[data_type], scan_interval, labels)
+
+
+@dataclass(slots=True)
+class RegisterRun:
+    """A contiguous block of registers, read with a single request.
+    Each entry has a matching byte offset into the packed response and decoder, resolved when it is added.
+    """
+
+    start: int
+    length: int = 0
+    scan_interval: float = 0
+    timeout: float = 0
+    entries: list = field(default_factory=list)
+    offsets: list = field(default_factory=list)
+    decoders: list = field(default_factory=list, repr=False)
+    pack: object = field(default=None, repr=False)
+
+    @property
+    def end(self):
+        return self.start + self.length
+
+    @property
+    def rtu_frame_bytes(self):
+        """Bytes sent and received on the wire to read this block over RTU.
+        The request is 8 bytes, the response is 5 bytes plus 2 per register.
+        """
+        return 8 + 5 + 2 * self.length
+
+    def add(self, entry):
+        self.entries.append(entry)
+        self.offsets.append((entry.address - self.start) * 2)
+        self.decoders.append(DECODER_MAP[entry.data_type])
+        self.length = max(self.end, entry.end) - self.start
+        self.pack = Struct(f">{self.length}H").pack
+
+
+def plan_reads(entries, max_block, max_gap=0):
+    """Coalesce register entries into as few block reads as possible.
+    Entries are grouped by scan interval and sorted by address, a run is extended while the next entry
+    has the same scan interval, starts no more than max_gap registers past its end,
+    and the run fits in max_block registers.
+    """
+    runs = []
+    for entry in sorted(entries, key=lambda entry: (entry.scan_interval, entry.address)):
+        run = runs[-1] if runs else None
+        if (
+            run is None
+            or entry.scan_interval != run.scan_interval
+            or entry.address > run.end + max_gap
+            or max(run.end, entry.end) - run.start > max_block
+        ):
+            run = RegisterRun(entry.address, scan_interval=entry.scan_interval)
+            runs.append(run)
+        run.add(entry)
+    return runs